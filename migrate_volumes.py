@@ -3,11 +3,19 @@
 """Tools to automate volume migration in ACS."""
 import sys
 import time
+import asyncio
 import glob
+import operator
 import os
 # import pprint
 import argparse
+import csv
+import fcntl
+import functools
 import textwrap
+import threading
+from concurrent.futures import (
+    CancelledError, ThreadPoolExecutor, as_completed)
 from cs import CloudStack, read_config
 
 PARSER = argparse.ArgumentParser(
@@ -32,6 +40,11 @@ PARSER = argparse.ArgumentParser(
                 --input-list /tmp/somevolumes.csv \
                 --dest-storage SAN1-XEN01-0017
 
+    Migrate all volumes according to list, at most 4 at the same time
+        ./migrate_volumes.py --do-migrate --non-interactive
+            --max-concurrent 4 --input-list /tmp/somevolumes.csv
+            --dest-storage SAN1-XEN01-0017
+
     Monitor Jobstatus
        watch python3 migrate_volumes.py --monitor-migrations
 
@@ -61,6 +74,12 @@ PARSER.add_argument('--output-list',
                     dest='output_list',
                     help='Write migratelist to file.',
                     required=False)
+PARSER.add_argument('--concurrency',
+                    dest='concurrency',
+                    type=int,
+                    default=8,
+                    help='Number of parallel API requests (default: 8).',
+                    required=False)
 
 
 PARSER.add_argument('--interactive',
@@ -78,6 +97,21 @@ PARSER.add_argument('--do-migrate',
                     action='store_true',
                     help='Start to migrate volumes.',
                     required=False)
+PARSER.add_argument('--max-concurrent',
+                    dest='max_concurrent',
+                    type=int,
+                    default=4,
+                    help='Number of migrations to run at the same time '
+                    'with --non-interactive (default: 4).',
+                    required=False)
+PARSER.add_argument('--skip-revalidation',
+                    dest='skip_revalidation',
+                    action='store_true',
+                    help='Trust VM and volume state from --input-list '
+                    'instead of querying the volumes again. The '
+                    'live/offline mode is then taken from the list, not '
+                    're-read before migrations that start late.',
+                    required=False)
 PARSER.add_argument('--input-list',
                     dest='input_list',
                     help='Read migratelist from file.',
@@ -94,192 +128,505 @@ PARSER.add_argument('--monitor-migrations',
                     action='store_true',
                     required=False)
 
-ARGS = PARSER.parse_args()
+# Set by main().
+ARGS = None
+CS = None
+
+# Factor to convert bytes to GiB.
+GIB = 1.0 / (1024 ** 3)
+
+# Seconds between job status queries while waiting for a migration.
+POLL_INTERVAL = 10
+# Seconds after which the prefetched VM state is read again before a
+# volume is migrated.
+REVALIDATE_AFTER = 60
+JOBLIST_LOCK = threading.Lock()
+
+# Seconds to keep listProjects/listStoragePools results.
+CACHE_TTL = 60
+API_CACHE = {}
+
+
+def cached(key, load):
+    """Return result of load(), cached under key for CACHE_TTL seconds!"""
+    now = time.monotonic()
+    if key in API_CACHE and now - API_CACHE[key][0] < CACHE_TTL:
+        return API_CACHE[key][1]
+    result = load()
+    API_CACHE[key] = (now, result)
+    return result
+
+
+def cached_call(acs, method, **kwargs):
+    """Return result of API method, cached for CACHE_TTL seconds!"""
+    return cached((id(acs), method, tuple(sorted(kwargs.items()))),
+                  lambda: getattr(acs, method)(**kwargs))
+
+
+def list_projects(acs):
+    """Return (cached) list of all projects!"""
+    # An installation without projects yields an empty list, not a KeyError.
+    return cached_call(acs, 'listProjects', listall=True, fetch_list=True)
+
+
+def list_storage_pools(acs):
+    """Return (cached) list of all storage pools!"""
+    return cached_call(acs, 'listStoragePools', listall=True,
+                       fetch_list=True)
+
+
+def projects_by_name(acs):
+    """Return (cached) dict of project ids keyed by project name!"""
+    return cached((id(acs), 'projects_by_name'), lambda: {
+        project["name"]: project["id"]
+        for project in list_projects(acs)})
+
+
+def storages_by_name(acs):
+    """Return (cached) dict of storage ids keyed by storage name!"""
+    return cached((id(acs), 'storages_by_name'), lambda: {
+        storage["name"]: storage["id"]
+        for storage in list_storage_pools(acs)})
 
 
 def get_project_id(projectname):
     """Return project_id for projectname!"""
-    project_container = CS.listProjects(listall=True)
-    projects = project_container["project"]
-
-    for project in projects:
-        if project["name"] == projectname:
-            return project["id"]
+    project_id = projects_by_name(CS).get(projectname, '')
+    if project_id != '':
+        return project_id
 
     print('Valid project names are:')
-    for project in sorted(projects, key=lambda key: (key["name"])):
-        print('{name}'.format(name=project["name"]))
+    for name in sorted(projects_by_name(CS)):
+        print('{name}'.format(name=name))
     raise NameError('Projectname unknown.')
 
 
-def collect_volumes(project_id, overall_volumes):
-    """Collect information about all volumes through ACS API!"""
+def list_volumes(project_id, storage_id=None):
+    """Return list of all volumes for project_id through ACS API!"""
     # print(f'List volumes for project_id=\"{project_id}\".')
+    filters = {}
     if project_id != 'n.a.':
-        volumes_container = CS.listVolumes(
-            listall=True, projectid=project_id)
-    else:
-        project_id = 'n.a.'
-        volumes_container = CS.listVolumes(listall=True)
+        filters['projectid'] = project_id
+    if storage_id:
+        filters['storageid'] = storage_id
+    # fetch_list makes cs request every page instead of only the first.
+    return CS.listVolumes(listall=True, fetch_list=True, **filters)
 
-    # print(f'{volumes_container}')
-    if volumes_container:
-        volumes = volumes_container["volume"]
-    else:
-        volumes = {}
 
+def volumes_with_defaults(volumes):
+    """Return volumes with missing fields set!"""
     # pprint.pprint(volumes)
     for volume in volumes:
-        if "vmname" not in volume:
-            volume.update({'vmname': 'n.a.'})
-        if "vmstate" not in volume:
-            volume.update({'vmstate': 'n.a.'})
-        if "project" not in volume:
-            volume.update({'project': 'n.a.'})
-
-        overall_volumes.append(volume)
+        volume.setdefault('vmname', 'n.a.')
+        volume.setdefault('vmstate', 'n.a.')
+        volume.setdefault('project', 'n.a.')
+    return volumes
+
+
+def collect_volumes(project_id, overall_volumes, storage_id=None):
+    """Collect information about all volumes through ACS API!"""
+    overall_volumes.extend(
+        volumes_with_defaults(list_volumes(project_id, storage_id)))
     # pprint.pprint(overall_volumes)
 
 
+def volume_sort_key(volume):
+    """Return key to sort volumes by domain, project, vmname and name!"""
+    return (volume['domain'].lower(), volume['project'].lower(),
+            volume['vmname'].lower(), volume['name'].lower())
+
+
 def printout_volumes(output_list, overall_volumes):
     """Print list of all volumes in overall_volumes!"""
-    output_list.write(
-        'id;domain;project;vmname;vmstate;name;state;storage;size\n')
-
-    for volume in sorted(overall_volumes, key=lambda i: (
-            i['domain'].lower(), i['project'].lower(),
-            i['vmname'].lower(), i['name'].lower())):
-        volume_id = volume["id"]
-        volume_name = volume["name"]
-        if "vmname" not in volume:
-            volume_vmname = 'n.a.'
-        else:
-            volume_vmname = volume["vmname"]
-        if "vmstate" not in volume:
-            volume_vmstate = 'n.a.'
-        else:
-            volume_vmstate = volume["vmstate"]
-        volume_domain = volume["domain"]
-        if "project" not in volume:
-            volume_project = 'n.a.'
-        else:
-            volume_project = volume["project"]
-        if "storage" in volume:
-            volume_storage = volume["storage"]
-        else:
-            volume_storage = 'n.a.'
-        volume_size = volume["size"]
-        volume_state = volume["state"]
-        # if "status" not in volume:
-        #     volume_status = 'n.a.'
-        # else:
-        #     volume_status = volume["status"]
+    writer = csv.writer(output_list, delimiter=';', lineterminator='\n')
+    writer.writerow(['id', 'domain', 'project', 'vmname', 'vmstate', 'name',
+                     'state', 'storage', 'size'])
+
+    for volume in sorted(overall_volumes, key=volume_sort_key):
+        # vmname, vmstate and project are set by volumes_with_defaults.
+        writer.writerow([
+            volume["id"], volume["domain"], volume["project"],
+            volume["vmname"], volume["vmstate"], volume["name"],
+            volume["state"], volume.get("storage", 'n.a.'), volume["size"]])
+
+
+def collect_project_volumes(project_ids, overall_volumes, storage_id=None):
+    """Collect volumes of the projects in project_ids through ACS API!"""
+    # One listVolumes round-trip per project, run in parallel. Results
+    # are merged into overall_volumes here, in the main thread.
+    with ThreadPoolExecutor(max_workers=ARGS.concurrency) as executor:
+        results = list(executor.map(
+            functools.partial(list_volumes, storage_id=storage_id),
+            project_ids))
+    for volumes in results:
+        overall_volumes.extend(volumes_with_defaults(volumes))
+
+
+def collect_all_volumes(overall_volumes, storage_id=None):
+    """Collect volumes of all projects and without project through ACS API!"""
+    projects = list_projects(CS)
+
+    project_ids = [project["id"] for project in sorted(
+        projects, key=lambda key: key["name"])]
+    project_ids.append('n.a.')
+    collect_project_volumes(project_ids, overall_volumes, storage_id)
+
+
+def fetch_all_volumes_by_id():
+    """Return dict of all volumes keyed by volume id!"""
+    overall_volumes = []
+    collect_all_volumes(overall_volumes)
+    return {volume["id"]: volume for volume in overall_volumes}
+
+
+def fetch_migratelist_volumes(migratelist):
+    """Return dict of all volumes in migratelist keyed by volume id!"""
+    # Only list the projects named in the migratelist. If a project is
+    # unknown or a volume moved, fall back to listing all volumes.
+    project_ids = projects_by_name(CS)
+    volumes_by_id = {}
+    if all(fields_dict['project'] in project_ids
+           or fields_dict['project'] == 'n.a.'
+           for fields_dict in migratelist):
+        overall_volumes = []
+        collect_project_volumes(
+            sorted({project_ids.get(fields_dict['project'], 'n.a.')
+                    for fields_dict in migratelist}),
+            overall_volumes)
+        volumes_by_id = {volume["id"]: volume for volume in overall_volumes}
+    if any(fields_dict['id'] not in volumes_by_id
+           for fields_dict in migratelist):
+        volumes_by_id = fetch_all_volumes_by_id()
+
+    missing = [fields_dict['id'] for fields_dict in migratelist
+               if fields_dict['id'] not in volumes_by_id]
+    if missing:
+        raise Exception(
+            'The volumes \"{volumes}\" do not exist'.format(
+                volumes='\", \"'.join(missing)))
+    return volumes_by_id
 
-        if ARGS.prep_sr and ARGS.prep_sr != volume_storage:
-            continue
 
-        output_list.write(
-            f'{volume_id};{volume_domain};{volume_project};'
-            f'{volume_vmname};{volume_vmstate};{volume_name};'
-            f'{volume_state};{volume_storage};{volume_size}\n')
+def find_volume(volume_id):
+    """Return volume for volume_id through ACS API, None if it is gone!"""
+    volumes = volumes_with_defaults(
+        CS.listVolumes(listall=True, id=volume_id, fetch_list=True))
+    if not volumes:
+        return None
+    return volumes[0]
+
+
+def lookup_volume(volume_id):
+    """Return volume for volume_id through ACS API!"""
+    volume = find_volume(volume_id)
+    if volume is None:
+        raise Exception(
+            'The volume \"{volume}\" does not exist'.format(
+                volume=volume_id))
+    return volume
 
 
 def prepare_output_list():
     """Iterate over all projects and build list of all volumes!"""
-    if ARGS.output_list is not None:
-        output_list = open(ARGS.output_list, 'w')
-    else:
-        output_list = sys.stdout
-
-    projects_container = CS.listProjects(listall=True)
-    projects = projects_container["project"]
+    # Let the API only return volumes on the --prep-sr storage.
+    storage_id = None
+    if ARGS.prep_sr:
+        storage_id = get_storageid(CS, ARGS.prep_sr)
 
     overall_volumes = []
     if ARGS.prep_proj:
         project_id = get_project_id(ARGS.prep_proj)
 
-        collect_volumes(project_id, overall_volumes)
+        collect_volumes(project_id, overall_volumes, storage_id)
     else:
-        for project in sorted(projects, key=lambda key: key["name"]):
-            # project_name = project["name"]
-            # project_id = project["id"]
-            # print(f'{project_id}')
-            collect_volumes(project["id"], overall_volumes)
-        collect_volumes('n.a.', overall_volumes)
+        collect_all_volumes(overall_volumes, storage_id)
 
     # pprint.pprint(overall_volumes)
-    printout_volumes(output_list, overall_volumes)
+    if ARGS.output_list is not None:
+        with open(ARGS.output_list, 'w', buffering=1 << 20,
+                  newline='') as output_list:
+            printout_volumes(output_list, overall_volumes)
+    else:
+        printout_volumes(sys.stdout, overall_volumes)
+
+
+def joblist_filename(prefix):
+    """Return name of the joblist all migrations are appended to!"""
+    return f'{prefix}current'
+
+
+def finished_jobs_filename(prefix):
+    """Return name of the file caching the state of finished jobs!"""
+    return f'{prefix}done'
+
+
+# Volume fields cached with each finished job, after jobid, jobstatus and
+# jobresultcode.
+FINISHED_VOLUME_FIELDS = ['vmname', 'vmstate', 'name', 'size', 'state',
+                          'storage']
+
+
+def read_finished_jobs(prefix):
+    """Return cached jobs_containers and volumes of finished jobs by jobid!"""
+    # Rows without volume fields (older versions) only cache the job. A
+    # volume that was already gone is cached as an empty dict.
+    finished_jobs = {}
+    finished_volumes = {}
+    if os.path.exists(finished_jobs_filename(prefix)):
+        with open(finished_jobs_filename(prefix), newline='') as input_file:
+            for fields in csv.reader(input_file, delimiter=';'):
+                if not fields:
+                    continue
+                finished_jobs[fields[0]] = {
+                    'jobstatus': int(fields[1]),
+                    'jobresultcode': int(fields[2])}
+                if len(fields) < 3 + len(FINISHED_VOLUME_FIELDS):
+                    continue
+                volume = dict(zip(FINISHED_VOLUME_FIELDS, fields[3:]))
+                if volume['size'] == 'n.a.':
+                    volume = {}
+                else:
+                    volume['size'] = int(volume['size'])
+                finished_volumes[fields[0]] = volume
+    return finished_jobs, finished_volumes
+
+
+def record_finished_jobs(prefix, jobs, volumes):
+    """Append jobs_containers and volumes of jobs to finished jobs file!"""
+    if not jobs:
+        return
+    with open(finished_jobs_filename(prefix), 'a', newline='') as output_file:
+        writer = csv.writer(output_file, delimiter=';', lineterminator='\n')
+        for jobid, jobs_container in jobs.items():
+            volume = volumes[jobid]
+            writer.writerow(
+                [jobid, jobs_container["jobstatus"],
+                 jobs_container["jobresultcode"]] +
+                [volume.get(field, 'n.a.')
+                 for field in FINISHED_VOLUME_FIELDS])
+
+
+def consolidate_joblists(prefix):
+    """Move entries of old one-per-migration joblists into the joblist!"""
+    # Older versions wrote one {prefix}YYYYmmdd-HHMMSS file per migration.
+    if not glob.glob(f'{prefix}[0-9]*'):
+        return
+    with open(joblist_filename(prefix), 'a') as joblist:
+        # Several monitors may run at once, so merge under an exclusive
+        # lock and look for the files again once it is held.
+        fcntl.flock(joblist, fcntl.LOCK_EX)
+        for file in sorted(glob.glob(f'{prefix}[0-9]*')):
+            try:
+                with open(file) as input_file:
+                    lines = [line.rstrip('\n') + '\n'
+                             for line in input_file if line.strip()]
+            except FileNotFoundError:
+                continue
+            joblist.writelines(lines)
+            joblist.flush()
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+
+def get_migrate_mode(vmstate):
+    """Return migrate_mode for a volume attached to a VM in vmstate!"""
+    if vmstate == 'Running':
+        return 'live'
+    if vmstate == 'Stopped':
+        return 'offline'
+    raise Exception('Unexpected VMState!')
+
+
+def current_migrate_mode(volume_id, migrate_mode, fetched_at):
+    """Return migrate_mode, read again once the prefetch is stale!"""
+    # fetched_at is None with --skip-revalidation: trust the migratelist.
+    if fetched_at is None or time.monotonic() - fetched_at < REVALIDATE_AFTER:
+        return migrate_mode
+    current_mode = get_migrate_mode(lookup_volume(volume_id)['vmstate'])
+    if current_mode != migrate_mode:
+        print(f'VM state of volume {volume_id} changed, '
+              f'migrating {current_mode}.')
+    return current_mode
+
+
+def start_migration(volume_id, migrate_mode, dst_storage):
+    """Start migration of volume_id and return its jobid!"""
+    if migrate_mode == 'live':
+        migrate_answer = CS.migrateVolume(
+            volumeid=volume_id,
+            storageid=dst_storage,
+            livemigrate=True)
+    if migrate_mode == 'offline':
+        migrate_answer = CS.migrateVolume(
+            volumeid=volume_id,
+            storageid=dst_storage)
+    return migrate_answer['jobid']
+
+
+def record_migration(joblist, volume_id, jobid, started):
+    """Append started migration to the joblist and sync it to disk!"""
+    with JOBLIST_LOCK:
+        csv.writer(
+            joblist, delimiter=';',
+            lineterminator='\n').writerow([volume_id, jobid, started])
+        joblist.flush()
+        os.fsync(joblist.fileno())
+
+
+def migrate_and_wait(joblist, volume_id, migrate_mode, dst_storage,
+                     fetched_at, stop):
+    """Migrate volume_id, wait for the job and return its jobs_container!"""
+    # stop is set by the first failing worker, before its future is done,
+    # so no worker picks up a new volume after an error.
+    if stop.is_set():
+        raise CancelledError()
+    try:
+        jobs_container = wait_for_migration(
+            joblist, volume_id, migrate_mode, dst_storage, fetched_at)
+    except BaseException:
+        stop.set()
+        raise
+    if jobs_container["jobstatus"] != 1:
+        stop.set()
+    return jobs_container
+
+
+def wait_for_migration(joblist, volume_id, migrate_mode, dst_storage,
+                       fetched_at):
+    """Migrate volume_id, wait for the job and return its jobs_container!"""
+    # The volume may have waited for a worker a long time.
+    migrate_mode = current_migrate_mode(volume_id, migrate_mode, fetched_at)
+    started = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    jobid = start_migration(volume_id, migrate_mode, dst_storage)
+    record_migration(joblist, volume_id, jobid, started)
+    while True:
+        jobs_container = CS.queryAsyncJobResult(listall=True, jobid=jobid)
+        if jobs_container["jobstatus"] != 0:
+            return jobs_container
+        time.sleep(POLL_INTERVAL)
+
+
+def migrate_queued(joblist, queued_migrations, dst_storage, fetched_at):
+    """Migrate queued volumes, at most ARGS.max_concurrent at a time!"""
+    # Each worker keeps its migration running until the job finished, so
+    # at most ARGS.max_concurrent migrations run at the same time.
+    # On the first error (or a failed job, jobstatus 2) no further
+    # migrations are started; the ones already running are still waited
+    # for and reported. The same holds on Ctrl-C.
+    failed = []
+    cancelled = []
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=ARGS.max_concurrent) as executor:
+        futures = {
+            executor.submit(migrate_and_wait, joblist, fields_dict['id'],
+                            migrate_mode, dst_storage, fetched_at,
+                            stop): fields_dict
+            for fields_dict, migrate_mode in queued_migrations}
+        try:
+            for future in as_completed(futures):
+                fields_dict = futures[future]
+                volume_label = (
+                    f'{fields_dict["vmname"]}-{fields_dict["name"]}')
+                if future.cancelled():
+                    cancelled.append(volume_label)
+                    continue
+                try:
+                    jobs_container = future.result()
+                except CancelledError:
+                    cancelled.append(volume_label)
+                    continue
+                except Exception as error:
+                    print(f'Failed {volume_label}: {error!r}')
+                    failed.append(volume_label)
+                    for pending in futures:
+                        pending.cancel()
+                    continue
+                if jobs_container["jobstatus"] != 1:
+                    print(f'Failed {volume_label}: '
+                          f'job-status {jobs_container["jobstatus"]} '
+                          f'job-resultcode '
+                          f'{jobs_container["jobresultcode"]}')
+                    failed.append(volume_label)
+                    for pending in futures:
+                        pending.cancel()
+                    continue
+                print(f'Finished {volume_label}: '
+                      f'job-status {jobs_container["jobstatus"]} '
+                      f'job-resultcode {jobs_container["jobresultcode"]}')
+        except BaseException:
+            stop.set()
+            print('Interrupted, waiting for running migrations to finish. '
+                  'No further migrations are started.')
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
+    if cancelled:
+        print(f'Not started after error: {", ".join(cancelled)}')
+    if failed:
+        raise Exception(
+            'Migration failed for {volumes}.'.format(
+                volumes=', '.join(failed)))
 
 
 def do_migrate(prefix, dst_storage):
     """Migrate volumes defined by textfile!"""
-    with open(ARGS.input_list) as input_list:
-        for line in input_list:
-            fields = line.split(";")
-            fields_dict = {}
-            fields_dict.update({'id': fields[0]})
-            fields_dict.update({'domain': fields[1]})
-            fields_dict.update({'project': fields[2]})
-            fields_dict.update({'vmname': fields[3]})
-            fields_dict.update({'vmstate': fields[4]})
-            fields_dict.update({'name': fields[5]})
-            fields_dict.update({'state': fields[6]})
-            fields_dict.update({'storage': fields[7]})
-            fields_dict.update({'size': fields[8]})
-
-            if fields_dict['id'] == 'id':
-                continue
-
-            volume_id = fields_dict['id']
-            volumes_container = CS.listVolumes(listall=True, id=volume_id)
-            volumes = volumes_container["volume"]
-
-            # volume_vmstate = volumes[0]['vmstate']
-            # volume_state = volumes[0]['state']
-            # volume_storage = volumes[0]['storage']
-            # volume_name = volumes[0]['name']
-            # volume_vmname = volumes[0]['vmname']
-
-            if volumes[0]['vmstate'] == 'Running':
-                migrate_mode = 'live'
-            elif volumes[0]['vmstate'] == 'Stopped':
-                migrate_mode = 'offline'
+    with open(ARGS.input_list, newline='') as input_list:
+        # The header line written by printout_volumes names the fields.
+        migratelist = list(csv.DictReader(input_list, delimiter=';'))
+
+    # With --skip-revalidation the fields of the migratelist are used as is.
+    # Otherwise all volumes are checked against one prefetched listing
+    # before the first migration starts. Its VM state is used as long as
+    # it is younger than REVALIDATE_AFTER, later it is read again per
+    # volume right before the migration.
+    volumes_by_id = None
+    fetched_at = None
+    if not ARGS.skip_revalidation:
+        volumes_by_id = fetch_migratelist_volumes(migratelist)
+        fetched_at = time.monotonic()
+    queued_migrations = []
+    filename = joblist_filename(prefix)
+    print(filename)
+    # One line-buffered handle on the joblist for all migrations.
+    with open(filename, 'a', buffering=1, newline='') as joblist:
+        for fields_dict in migratelist:
+            if volumes_by_id is None:
+                volume = fields_dict
             else:
-                raise Exception('Unexpected VMState!')
+                volume = volumes_by_id[fields_dict['id']]
+
+            migrate_mode = get_migrate_mode(volume['vmstate'])
 
             print('----------------------------------')
-            print(f'Please confirm migration ({migrate_mode:7}): '
-                  f'{volumes[0]["vmname"]:25} {volumes[0]["name"]:17} '
-                  f'{float(fields_dict["size"])/1024/1024/1024:20} GB         '
-                  f'from {volumes[0]["storage"]:20} to '
+            if ARGS.non_interactive:
+                print(f'Queue migration ({migrate_mode:7}): ', end='')
+            else:
+                print(f'Please confirm migration ({migrate_mode:7}): ',
+                      end='')
+            print(f'{volume["vmname"]:25} {volume["name"]:17} '
+                  f'{float(fields_dict["size"]) * GIB:20} GB         '
+                  f'from {volume["storage"]:20} to '
                   f'{ARGS.dest_storage:20}       '
-                  f'VM is {volumes[0]["vmstate"]} volume '
-                  f'is {volumes[0]["state"]}')
+                  f'VM is {volume["vmstate"]} volume '
+                  f'is {volume["state"]}')
+            if ARGS.non_interactive:
+                queued_migrations.append((fields_dict, migrate_mode))
+                continue
+
             answer = None
             while answer not in ("yes", "no"):
                 answer = input("Enter yes or no: ")
                 if answer == "yes":
                     print('Yes! Migrating....')
-                    if migrate_mode == 'live':
-                        migrate_answer = CS.migrateVolume(
-                            volumeid=fields_dict['id'],
-                            storageid=dst_storage,
-                            livemigrate=True)
-                    if migrate_mode == 'offline':
-                        migrate_answer = CS.migrateVolume(
-                            volumeid=fields_dict['id'],
-                            storageid=dst_storage)
-                    jobid = migrate_answer['jobid']
-
-                    filename = '{prefix}{time}'.format(
-                        prefix=prefix,
-                        time=time.strftime("%Y%m%d-%H%M%S", time.gmtime()))
-                    print(filename)
-                    output_file = open(filename, 'w')
-                    output_file.write(
-                        f'{fields_dict["id"]};{jobid};'
-                        f'{time.strftime("%Y%m%d-%H%M%S", time.gmtime())}')
-                    output_file.close()
+                    migrate_mode = current_migrate_mode(
+                        fields_dict['id'], migrate_mode, fetched_at)
+                    started = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+                    jobid = start_migration(
+                        fields_dict['id'], migrate_mode, dst_storage)
+                    record_migration(
+                        joblist, fields_dict['id'], jobid, started)
 
                 elif answer == "no":
                     print(
@@ -288,6 +635,10 @@ def do_migrate(prefix, dst_storage):
                 else:
                     print("Please enter yes or no.")
 
+        if queued_migrations:
+            migrate_queued(
+                joblist, queued_migrations, dst_storage, fetched_at)
+
 
 # def writeout_joblist(joblist, prefix):
 #     filename = f'{prefix}{time.strftime("%Y%m%d-%H%M%S", time.gmtime())}'
@@ -299,55 +650,109 @@ def do_migrate(prefix, dst_storage):
 #     output_list.close()
 
 
-def migration_status(prefix):
+async def query_migration(semaphore, jobid):
+    """Return jobs_container for one migration!"""
+    async with semaphore:
+        return await asyncio.to_thread(
+            CS.queryAsyncJobResult, listall=True, jobid=jobid)
+
+
+async def query_volume(semaphore, volumeid):
+    """Return volume for one migration, None if it was deleted!"""
+    async with semaphore:
+        return await asyncio.to_thread(find_volume, volumeid)
+
+
+async def migration_status(prefix):
     """Print status of last migrations!"""
-    status_list = []
-    os.chdir(os.path.dirname(prefix))
-    for file in glob.glob(f'{os.path.basename(prefix)}*'):
-        with open(file) as input_file:
-            lines = input_file.readlines()
-            for line in lines:
-                fields = line.split(';')
+    consolidate_joblists(prefix)
+    entries = []
+    if os.path.exists(joblist_filename(prefix)):
+        with open(joblist_filename(prefix), newline='') as input_file:
+            for fields in csv.reader(input_file, delimiter=';'):
+                if not fields:
+                    continue
                 volumeid = fields[0]
                 jobid = fields[1]
-                started = fields[2].rstrip()
-
-                volumes_container = CS.listVolumes(
-                    listall=True, id=volumeid)
-                # pprint.pprint(volumes_container)
-                volumes = volumes_container['volume']
-
-                # for volume in volumes:
-                #     volume_name = volume['name']
-                #     volume_vmname = volume['vmname']
-                #     volume_storage = volume['storage']
-
-                jobs_container = CS.queryAsyncJobResult(
-                    listall=True, jobid=jobid)
-                # pprint.pprint(jobs_container)
-
-                status_list.append(
-                    {
-                        'vmname': volumes[0]["vmname"],
-                        'vmstate': volumes[0]["vmstate"],
-                        'name': volumes[0]["name"], 'size': volumes[0]["size"],
-                        'volume_state': volumes[0]["state"],
-                        'storage': volumes[0]["storage"],
-                        'volumeid': volumeid, 'started': started,
-                        'job-status': jobs_container["jobstatus"],
-                        'job-resultcode': jobs_container["jobresultcode"]})
+                started = fields[2]
+                entries.append((volumeid, jobid, started))
+
+    # Jobs which already finished (jobstatus != 0) are not queried again,
+    # and their volumes are shown as cached when the job finished.
+    jobs_by_id, finished_volumes = read_finished_jobs(prefix)
+    pending_jobids = list(dict.fromkeys(
+        jobid for _, jobid, _ in entries if jobid not in jobs_by_id))
+
+    # Query all pending migrations concurrently, at most ARGS.concurrency
+    # at a time.
+    semaphore = asyncio.Semaphore(ARGS.concurrency)
+    tasks = [asyncio.create_task(query_migration(semaphore, jobid))
+             for jobid in pending_jobids]
+    show_progress = sys.stderr.isatty()
+    for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+        await task
+        if show_progress:
+            print(f'\rQueried {done}/{len(tasks)} jobs',
+                  end='', file=sys.stderr, flush=True)
+    if show_progress and tasks:
+        print(file=sys.stderr)
+    jobs_by_id.update({jobid: task.result()
+                       for jobid, task in zip(pending_jobids, tasks)})
+
+    # Only volumes without a cached state are looked up, after the job
+    # queries, so a job that just finished caches the migrated volume.
+    volumeids = list(dict.fromkeys(
+        volumeid for volumeid, jobid, _ in entries
+        if jobid not in finished_volumes))
+    looked_up = await asyncio.gather(
+        *(query_volume(semaphore, volumeid) for volumeid in volumeids))
+    volumes_by_id = {volumeid: volume or {}
+                     for volumeid, volume in zip(volumeids, looked_up)}
+
+    newly_finished = {
+        jobid: volumeid for volumeid, jobid, _ in entries
+        if jobid not in finished_volumes
+        and jobs_by_id[jobid]["jobstatus"] != 0}
+    record_finished_jobs(
+        prefix,
+        {jobid: jobs_by_id[jobid] for jobid in newly_finished},
+        {jobid: volumes_by_id[volumeid]
+         for jobid, volumeid in newly_finished.items()})
+
+    status_list = []
+    for volumeid, jobid, started in entries:
+        # Volumes deleted after their migration are shown as n.a.
+        if jobid in finished_volumes:
+            volume = finished_volumes[jobid]
+        else:
+            volume = volumes_by_id[volumeid]
+        jobs_container = jobs_by_id[jobid]
+        # pprint.pprint(jobs_container)
+
+        status_list.append(
+            {
+                'vmname': volume.get("vmname", 'n.a.'),
+                'vmstate': volume.get("vmstate", 'n.a.'),
+                'name': volume.get("name", 'n.a.'),
+                'size': volume["size"] * GIB if volume else 'n.a.',
+                'volume_state': volume.get("state", 'n.a.'),
+                'storage': volume.get("storage", 'n.a.'),
+                'volumeid': volumeid, 'started': started,
+                'job-status': jobs_container["jobstatus"],
+                'job-resultcode': jobs_container["jobresultcode"],
+                '_sort_key': (int(jobs_container["jobstatus"]),
+                              int(started.replace('-', '')))})
 
     print('Started         Status VM-Name' +
           '                   VM-State Volume-Name       '
           '           Size State      '
           'Storage              Volume-ID                             '
           'Job-Resultcode')
-    for job in sorted(
-            status_list, key=lambda i: (i['job-status'], i['started'])):
+    for job in sorted(status_list, key=operator.itemgetter('_sort_key')):
         print(
             f'{job["started"]} {job["job-status"]:6} '
             f'{job["vmname"]:25} {job["vmstate"]:8} '
-            f'{job["name"]:25} {job["size"]/1024/1024/1024:7} '
+            f'{job["name"]:25} {job["size"]:>7} '
             f'{job["volume_state"]:10} '
             f'{job["storage"]:20} '
             f'{job["volumeid"]}; '
@@ -356,58 +761,66 @@ def migration_status(prefix):
 
 def get_storageid(acs, storage_name):
     """Get storageid from name."""
-    storages_container = acs.listStoragePools(listall=True)
-    storages = storages_container["storagepool"]
-    # pprint.pprint(storages)
-    storage_id = ''
-    for storage in storages:
-        if storage["name"] == storage_name:
-            storage_id = storage["id"]
-    return storage_id
-
-
-# Reads ~/.cloudstack.ini
-CS = CloudStack(**read_config())
-
-# Check ARGS.dest_storage
-if ARGS.dest_storage:
-    if get_storageid(CS, ARGS.dest_storage) == '':
+    return storages_by_name(acs).get(storage_name, '')
+
+
+def main():
+    """Parse arguments, connect to ACS and run the requested action!"""
+    global ARGS, CS
+    ARGS = PARSER.parse_args()
+
+    if ARGS.prepare_migratelist and ARGS.do_migrate:
         raise Exception(
-            'The storage \"{storage}\" does not exist'.format(
-                storage=ARGS.dest_storage))
+            '--prepare_migrate and --do-migrate cannot be used together.')
 
-if ARGS.prep_sr:
-    if get_storageid(CS, ARGS.prep_sr) == '':
+    if ARGS.interactive and ARGS.non_interactive:
         raise Exception(
-            'The storage \"{storage}\" does not exist'.format(
-                storage=ARGS.prep_sr))
-
-if ARGS.prepare_migratelist and ARGS.do_migrate:
-    raise Exception(
-        '--prepare_migrate and --do-migrate cannot be used together.')
-
-if ARGS.interactive and ARGS.non_interactive:
-    raise Exception(
-        '--interactive and --non-interactive cannot be used together.')
-
-if ARGS.do_migrate and not ARGS.input_list:
-    raise Exception('Please enter --input-list with --do-migrate.')
-
-if ARGS.do_migrate and not ARGS.dest_storage:
-    raise Exception('Please enter --dest-storage with --do-migrate.')
-
-if ARGS.prepare_migratelist:
-    prepare_output_list()
-
-if ARGS.monitor_migrations:
-    migration_status('/tmp/joblist-')
-
-if ARGS.do_migrate:
-    DST_STORAGEID = get_storageid(CS, ARGS.dest_storage)
-    if DST_STORAGEID == '':
-        sys.exit(1)
-    # joblist = []
-    print('Migrate to storage_id \"' + DST_STORAGEID + '\"')
-    do_migrate('/tmp/joblist-', DST_STORAGEID)
-    # print(f'Joblist:\n{joblist}')
-    # writeout_joblist(joblist, '/tmp/joblist-')
+            '--interactive and --non-interactive cannot be used together.')
+
+    if ARGS.do_migrate and not ARGS.input_list:
+        raise Exception('Please enter --input-list with --do-migrate.')
+
+    if ARGS.do_migrate and not ARGS.dest_storage:
+        raise Exception('Please enter --dest-storage with --do-migrate.')
+
+    if ARGS.concurrency < 1:
+        raise Exception('--concurrency must be at least 1.')
+
+    if ARGS.max_concurrent < 1:
+        raise Exception('--max-concurrent must be at least 1.')
+
+    # Reads ~/.cloudstack.ini
+    CS = CloudStack(**read_config())
+
+    # Check ARGS.dest_storage
+    if ARGS.dest_storage:
+        if get_storageid(CS, ARGS.dest_storage) == '':
+            raise Exception(
+                'The storage \"{storage}\" does not exist'.format(
+                    storage=ARGS.dest_storage))
+
+    if ARGS.prep_sr:
+        if get_storageid(CS, ARGS.prep_sr) == '':
+            raise Exception(
+                'The storage \"{storage}\" does not exist'.format(
+                    storage=ARGS.prep_sr))
+
+    if ARGS.prepare_migratelist:
+        prepare_output_list()
+
+    if ARGS.monitor_migrations:
+        asyncio.run(migration_status('/tmp/joblist-'))
+
+    if ARGS.do_migrate:
+        dst_storageid = get_storageid(CS, ARGS.dest_storage)
+        if dst_storageid == '':
+            sys.exit(1)
+        # joblist = []
+        print('Migrate to storage_id \"' + dst_storageid + '\"')
+        do_migrate('/tmp/joblist-', dst_storageid)
+        # print(f'Joblist:\n{joblist}')
+        # writeout_joblist(joblist, '/tmp/joblist-')
+
+
+if __name__ == '__main__':
+    main()